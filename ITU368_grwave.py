@@ -5,14 +5,60 @@ Marcel van den Broek, 2025'''
 
 import numpy as np
 import matplotlib.pyplot as plt
-from ctypes import c_double, c_int, POINTER, Structure, CDLL, WinDLL, byref
+from ctypes import c_double, c_int, c_void_p, POINTER, Structure, CDLL, byref, cast, pointer
 import os
-from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import multiprocessing
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+try:
+    # Optional: numba to compile the distance loop of evaluate_distances
+    from numba import njit, prange, threading_layer, types
+    from numba.core import cgutils
+    from numba.extending import intrinsic
+except ImportError:
+    njit = None
+try:
+    # Optional: ahead-of-time compiled distance loop, see build_lfmf_driver.py
+    from lfmf_driver import sweep as _aot_sweep
+except ImportError:
+    _aot_sweep = None
+try:
+    # Optional: Cython extension to call LFMF from run, see build_lfmf_ext.py
+    from _lfmf import LFMF as _LFMFExtension
+except ImportError:
+    _LFMFExtension = None
+try:
+    # Optional: CFFI module to call LFMF from run, see _lfmf_cffi_build.py
+    import _lfmf_cffi
+except ImportError:
+    _lfmf_cffi = None
+
+logger = logging.getLogger(__name__)
 
 
 class LFMFError(Exception):
     pass
 
+# Messages of the error codes returned by LFMF
+_ERROR_MESSAGES = {
+    1000: "VALIDATION ERROR: h_tx__meter out of range",
+    1001: "VALIDATION ERROR: h_rx__meter out of range",
+    1002: "VALIDATION ERROR: f__mhz out of range",
+    1003: "VALIDATION ERROR: P_tx__watt out of range",
+    1004: "VALIDATION ERROR: N_s out of range",
+    1005: "VALIDATION ERROR: d__km out of range",
+    1006: "VALIDATION ERROR: epsilon out of range",
+    1007: "VALIDATION ERROR: sigma out of range",
+    1008: "VALIDATION ERROR: invalid value for pol"
+}
+
+def _lfmf_error(status):
+    ''' Create the LFMFError for an error code returned by LFMF.'''
+    msg = _ERROR_MESSAGES.get(status, "UNKNOWN ERROR")
+    return LFMFError(f"Error code {status}: {msg}")
+
 class Result(Structure):
     ''' Class containing the data returned from a C-function in the form of a
     C-struct. Class is used in the lfmf function as the return variable.'''
@@ -20,24 +66,157 @@ class Result(Structure):
                 ('E_dBuVm', c_double),
                 ('P_rx__dbm', c_double),
                 ('method', c_int)]
+
+class LFMFContext(Structure):
+    ''' Class containing the parameters of the C-function LFMF_batch that are
+    the same for every distance, passed once per sweep instead of per distance.'''
+    _fields_ = [('h_tx__meter', c_double),
+                ('h_rx__meter', c_double),
+                ('f__mhz', c_double),
+                ('P_tx__watt', c_double),
+                ('N_s', c_double),
+                ('epsilon', c_double),
+                ('sigma', c_double),
+                ('pol', c_int)]
+
+# numpy equivalent of the Result structure, used to receive the results of the
+# batch function for a whole array of distances at once
+RESULT_DTYPE = np.dtype([('A_btl__db', 'f8'),
+                         ('E_dBuVm', 'f8'),
+                         ('P_rx__dbm', 'f8'),
+                         ('method', 'i4'),
+                         ('_pad', 'i4')], align=True)
+
+if njit is not None:
+    @intrinsic
+    def _address_as_void_pointer(typingctx, src):
+        ''' Numba intrinsic that converts an integer address into a void pointer.'''
+        sig = types.voidptr(src)
+        def codegen(cgctx, builder, sig, args):
+            return builder.inttoptr(args[0], cgutils.voidptr_t)
+        return sig, codegen
+
+    # The workqueue threading layer of numba aborts the process when parallel
+    # functions run concurrently from several python threads
+    _sweep_lock = threading.Lock()
+
+    def _sweep_threadsafe():
+        ''' True if _sweep can be called concurrently from several threads.'''
+        try:
+            return threading_layer() != 'workqueue'
+        except ValueError:
+            # the threading layer is chosen on the first parallel call
+            return False
+
+    @njit(parallel=True, nogil=True, cache=True)
+    def _sweep(lfmf, h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s, distances, epsilon, sigma, pol, out_address, itemsize, status):
+        ''' Compiled loop calling LFMF for every distance, the result of distance
+        i is written at out_address + i * itemsize and its status in status[i].'''
+        for i in prange(distances.shape[0]):
+            status[i] = lfmf(h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s,
+                             distances[i], epsilon, sigma, pol,
+                             _address_as_void_pointer(out_address + i * itemsize))
+
+
+# LFMF shared library, loaded on first use by _load_library
+_lfmf_lib = None
+
+def _load_library():
+    ''' Load the LFMF shared library and define the argument and return types of
+    its functions. The library is loaded only once, later calls return the
+    already loaded library.'''
+    global _lfmf_lib
+    if _lfmf_lib is not None:
+        return _lfmf_lib
+    if os.name == 'posix':
+        # Linux or Mac
+        lib_path = os.path.join(os.path.dirname(__file__), 'LFMF.so')
+        lib = CDLL(lib_path)
+    else:
+        # Windows
+        from ctypes import WinDLL, WinError, get_last_error
+        from ctypes.wintypes import BOOL, DWORD, HMODULE, LPCWSTR
+        LOAD_WITH_ALTERED_SEARCH_PATH = 0x00000008
+        GET_MODULE_HANDLE_EX_FLAG_PIN = 0x00000001
+        lib_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'LFMF.dll'))
+        kernel32 = WinDLL('kernel32', use_last_error=True)
+        kernel32.LoadLibraryExW.argtypes = [LPCWSTR, c_void_p, DWORD]
+        kernel32.LoadLibraryExW.restype = HMODULE
+        kernel32.GetModuleHandleExW.argtypes = [DWORD, LPCWSTR, POINTER(HMODULE)]
+        kernel32.GetModuleHandleExW.restype = BOOL
+        # Load the library with its dependencies searched in its own folder, and
+        # pin it so it stays loaded until the process exits
+        handle = kernel32.LoadLibraryExW(lib_path, None, LOAD_WITH_ALTERED_SEARCH_PATH)
+        if not handle:
+            raise WinError(get_last_error())
+        if not kernel32.GetModuleHandleExW(GET_MODULE_HANDLE_EX_FLAG_PIN, lib_path, byref(HMODULE())):
+            raise WinError(get_last_error())
+        lib = WinDLL(lib_path, handle=handle)
+    # Define the argument and return types of the functions
+    lib.LFMF.argtypes = [c_double, c_double, c_double, c_double,
+                         c_double, c_double, c_double, c_double, 
+                         c_int, POINTER(Result)]
+    lib.LFMF.restype = c_int
+    if hasattr(lib, 'LFMF_batch'):
+        lib.LFMF_batch.argtypes = [POINTER(LFMFContext),
+                                   np.ctypeslib.ndpointer(dtype=np.float64, ndim=1, flags='C_CONTIGUOUS'),
+                                   c_int,
+                                   np.ctypeslib.ndpointer(dtype=RESULT_DTYPE, ndim=1, flags=('C_CONTIGUOUS', 'WRITEABLE'))]
+        lib.LFMF_batch.restype = c_int
+    if hasattr(lib, 'LFMF_batch_dB'):
+        lib.LFMF_batch_dB.argtypes = [POINTER(LFMFContext),
+                                      np.ctypeslib.ndpointer(dtype=np.float64, ndim=1, flags='C_CONTIGUOUS'),
+                                      c_int, c_int,
+                                      np.ctypeslib.ndpointer(dtype=np.float32, ndim=1, flags=('C_CONTIGUOUS', 'WRITEABLE')),
+                                      np.ctypeslib.ndpointer(dtype=np.int32, ndim=1, flags=('C_CONTIGUOUS', 'WRITEABLE'))]
+        lib.LFMF_batch_dB.restype = c_int
+    _lfmf_lib = lib
+    return _lfmf_lib
     
 class ITU368Grwave:
     ''' Class to compute the groundwave propagation using the C++ ITU 368 model.'''
     def __init__(self):
-        # Load the shared library
-        if os.name == 'posix':
-            # Linux or Mac
-            lib_path = os.path.join(os.path.dirname(__file__), 'LFMF.so')
-            self.lfmf_lib = CDLL(lib_path)  
+        # Shared library, loaded once for all instances
+        self.lfmf_lib = _load_library()
+        # The batch function is only available when LFMF_batch.cpp was included
+        # in the build of the library
+        self.has_batch = hasattr(self.lfmf_lib, 'LFMF_batch')
+        self.has_batch_dB = hasattr(self.lfmf_lib, 'LFMF_batch_dB')
+        # Separate function object of LFMF with a void pointer as result argument,
+        # which can be called from the numba compiled loop
+        if njit is not None:
+            self._lfmf_numba = self.lfmf_lib['LFMF']
+            self._lfmf_numba.argtypes = self.lfmf_lib.LFMF.argtypes[:-1] + [c_void_p]
+            self._lfmf_numba.restype = c_int
+        # Compiled call of LFMF used by run, if the Cython extension is built
+        if _LFMFExtension is not None:
+            self._lfmf_ext = _LFMFExtension(cast(self.lfmf_lib.LFMF, c_void_p).value)
+        else:
+            self._lfmf_ext = None
+        # Otherwise run calls LFMF through the CFFI module if it is built, or
+        # through ctypes
+        if _lfmf_cffi is not None:
+            _lfmf_cffi.lib.LFMF_set_address(cast(self.lfmf_lib.LFMF, c_void_p).value)
+            self._lfmf = _lfmf_cffi.lib.LFMF
         else:
-            # Windows
-            lib_path = os.path.join(os.path.dirname(__file__), 'LFMF.dll')
-            self.lfmf_lib = WinDLL(lib_path)
-        # Define the argument and return types of the function
-        self.lfmf_lib.LFMF.argtypes = [c_double, c_double, c_double, c_double,
-                                       c_double, c_double, c_double, c_double, 
-                                       c_int, POINTER(Result)]
-        self.lfmf_lib.LFMF.restype = c_int
+            self._lfmf = self.lfmf_lib.LFMF
+        # Result structure per thread, reused for every call of run
+        self._res_tls = threading.local()
+
+    def _new_result(self):
+        ''' Create a Result structure and the pointer to pass to self._lfmf.'''
+        if _lfmf_cffi is not None:
+            res = _lfmf_cffi.ffi.new('Result *')
+            return res, res
+        res = Result()
+        return res, pointer(res)
+
+    def _thread_result(self):
+        ''' Result structure and pointer of this thread, created on first use.'''
+        result = getattr(self._res_tls, 'result', None)
+        if result is None:
+            result = self._res_tls.result = self._new_result()
+        return result
 
     def run(self, h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s, d__km, epsilon, sigma, pol):
         ''' 
@@ -61,11 +240,16 @@ class ITU368Grwave:
             method: Method used for calculation (0 = Flat Earth with curve correction, 1 = Residue series)
         '''
 
-        # Create an instance of the Result structure
-        res = Result()
+        if self._lfmf_ext is not None:
+            # Call the function through the Cython extension
+            status, A_btl__db, E_dBuVm, P_rx__dbm, method = self._lfmf_ext(h_tx__meter, h_rx__meter, f__mhz, P_tx__watt,
+                                                                           N_s, d__km, epsilon, sigma, pol)
+        else:
+            # Reuse the Result structure of this thread
+            res, res_ptr = self._thread_result()
 
-        # Call the function
-        status = self.lfmf_lib.LFMF(h_tx__meter, 
+            # Call the function
+            status = self._lfmf(h_tx__meter, 
                                 h_rx__meter, 
                                 f__mhz, 
                                 P_tx__watt,
@@ -74,51 +258,175 @@ class ITU368Grwave:
                                 epsilon,
                                 sigma,
                                 pol,
-                                byref(res))
+                                res_ptr)
+            A_btl__db, E_dBuVm, P_rx__dbm, method = res.A_btl__db, res.E_dBuVm, res.P_rx__dbm, res.method
         
             # Check the status and print the results
         if status == 0:
-            return (res.A_btl__db, res.E_dBuVm, res.P_rx__dbm, res.method)
+            return (A_btl__db, E_dBuVm, P_rx__dbm, method)
+        else:
+            raise _lfmf_error(status)
+
+    def run_field(self, h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s, d__km, epsilon, sigma, pol, result_index=0):
+        ''' 
+        Same as run, but returns only the value at result_index of the results
+        of run (default: 0 = A_btl__db), without building the result tuple.
+        '''
+        # index in the result tuple, negative indices count from the end
+        result_index = range(len(Result._fields_))[result_index]
+        if self._lfmf_ext is not None:
+            # (status, A_btl__db, E_dBuVm, P_rx__dbm, method)
+            results = self._lfmf_ext(h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s, d__km, epsilon, sigma, pol)
+            if results[0] == 0:
+                return results[result_index + 1]
+            raise _lfmf_error(results[0])
+        res, res_ptr = self._thread_result()
+        status = self._lfmf(h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s, d__km, epsilon, sigma, pol, res_ptr)
+        if status == 0:
+            return getattr(res, Result._fields_[result_index][0])
         else:
-            error_messages = {
-                1000: "VALIDATION ERROR: h_tx__meter out of range",
-                1001: "VALIDATION ERROR: h_rx__meter out of range",
-                1002: "VALIDATION ERROR: f__mhz out of range",
-                1003: "VALIDATION ERROR: P_tx__watt out of range",
-                1004: "VALIDATION ERROR: N_s out of range",
-                1005: "VALIDATION ERROR: d__km out of range",
-                1006: "VALIDATION ERROR: epsilon out of range",
-                1007: "VALIDATION ERROR: sigma out of range",
-                1008: "VALIDATION ERROR: invalid value for pol"
-            }
-            msg = error_messages.get(status, "UNKNOWN ERROR")
-            raise LFMFError(f"Error code {status}: {msg}")
+            raise _lfmf_error(status)
         
-    def evaluate_distances(self, h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s, distances, epsilon, sigma, pol, result_index=0, max_workers=None):
+    def evaluate_distances(self, h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s, distances, epsilon, sigma, pol, result_index=0, max_workers=None, dtype=np.float64):
         """
-        Evaluate the propagation model for a range of distances in parallel using threads.
+        Evaluate the propagation model for a range of distances. If the library
+        provides LFMF_batch all distances are computed in a single call,
+        otherwise the distances are computed in parallel using a numba compiled
+        loop. Without numba the distances are computed in the loop of
+        lfmf_driver if it is built (see build_lfmf_driver.py), or using threads.
 
         Parameters:
             h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s, epsilon, sigma, pol: model parameters (same as in run)
-            distances: iterable of distances [km]
+            distances: array of distances [km]
             result_index: which value to return from the result tuple (default: 0 = A_btl__db)
             max_workers: number of threads (default: as many as CPUs)
+            dtype: dtype of the returned array (default: np.float64). With
+                np.float32 and result_index 0-2 the library writes the values
+                directly as float32 if it provides LFMF_batch_dB.
 
         Returns:
-            List of results (e.g., A_btl__db for each distance)
+            Array of results (e.g., A_btl__db for each distance), NaN where LFMF failed
+            (also for method, the error codes are logged in a warning).
         """
-        def compute_loss(d):
-            try:
-                return self.run(h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s, d, epsilon, sigma, pol)[result_index]
-            except LFMFError as e:
-                print(f"Error occurred for distance {d} km: {e}")
-                return np.nan
-
-        # Parallel computation using ThreadPoolExecutor
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            results = list(executor.map(compute_loss, distances))
+        distances = np.ascontiguousarray(distances, dtype=np.float64)
+        # index in the result tuple, negative indices count from the end
+        result_index = range(len(Result._fields_))[result_index]
+        if self.has_batch_dB and np.dtype(dtype) == np.float32 and 0 <= result_index <= 2:
+            # Compute all distances in a single call, storing only the requested value
+            ctx = LFMFContext(h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s, epsilon, sigma, pol)
+            out_dB = np.empty(distances.size, dtype=np.float32)
+            status = np.empty(distances.size, dtype=np.int32)
+            n_failed = self.lfmf_lib.LFMF_batch_dB(byref(ctx), distances, distances.size, result_index, out_dB, status)
+            if n_failed:
+                logger.warning("LFMF failed on %d of %d distances (error codes %s)",
+                               n_failed, distances.size, np.unique(status[status != 0]).tolist())
+            return out_dB
+
+        # Results of all distances, written directly by the library
+        out = np.empty(distances.size, dtype=RESULT_DTYPE)
+        if self.has_batch:
+            # Compute all distances in a single call to the library
+            ctx = LFMFContext(h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s, epsilon, sigma, pol)
+            self.lfmf_lib.LFMF_batch(byref(ctx), distances, distances.size, out)
+        elif _aot_sweep is not None or njit is not None:
+            status = np.zeros(distances.size, dtype=np.int32)
+            if njit is None:
+                # serial ahead-of-time compiled loop, only used without numba
+                # as the parallel JIT loop is faster once it is cached
+                _aot_sweep(cast(self.lfmf_lib.LFMF, c_void_p).value, h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s,
+                           distances, epsilon, sigma, pol, out.ctypes.data, RESULT_DTYPE.itemsize, status)
+            elif _sweep_threadsafe():
+                _sweep(self._lfmf_numba, h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s,
+                       distances, epsilon, sigma, pol, out.ctypes.data, RESULT_DTYPE.itemsize, status)
+            else:
+                with _sweep_lock:
+                    _sweep(self._lfmf_numba, h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s,
+                           distances, epsilon, sigma, pol, out.ctypes.data, RESULT_DTYPE.itemsize, status)
+            # same convention as LFMF_batch
+            failed = status != 0
+            out[failed] = (np.nan, np.nan, np.nan, 0, 0)
+            out['method'][failed] = -status[failed]
+        else:
+            # ctypes view on out, indexing it is much cheaper than creating a
+            # pointer to a slice of out for every distance
+            results = (Result * distances.size).from_buffer(out)
+            d_list = distances.tolist()
+
+            lfmf = self.lfmf_lib.LFMF
+
+            def compute_chunk(chunk):
+                for i in chunk:
+                    status = lfmf(h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s,
+                                  d_list[i], epsilon, sigma, pol, byref(results[i]))
+                    if status != 0:
+                        # same convention as LFMF_batch
+                        out[i] = (np.nan, np.nan, np.nan, -status, 0)
+
+            # Parallel computation using ThreadPoolExecutor, with a few chunks
+            # of distances per thread instead of a task per distance
+            n_chunks = 4 * (max_workers or os.cpu_count() or 1)
+            bounds = np.linspace(0, distances.size, n_chunks + 1).astype(int).tolist()
+            chunks = [range(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(compute_chunk, chunks))
+
+        # failed distances are NaN with the negative error code as method
+        failed = out['method'] < 0
+        n_failed = np.count_nonzero(failed)
+        if n_failed:
+            logger.warning("LFMF failed on %d of %d distances (error codes %s)",
+                           n_failed, distances.size, np.unique(-out['method'][failed]).tolist())
+        field = Result._fields_[result_index][0]
+        # contiguous copy of the field, so the structured buffer can be freed
+        results = np.ascontiguousarray(out[field], dtype=dtype)
+        if field == 'method' and np.issubdtype(results.dtype, np.floating):
+            # the error code is only reported in the warning, not as method
+            results[failed] = np.nan
         return results
-    
+
+    def evaluate_distances_mp(self, h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s, distances, epsilon, sigma, pol, result_index=0, max_workers=None):
+        """
+        Evaluate the propagation model for a range of distances in parallel using processes.
+        Useful when the library does not provide LFMF_batch and the threads of
+        evaluate_distances are limited by the python overhead per call.
+
+        Parameters:
+            Same as evaluate_distances, max_workers is the number of processes
+            (default: as many as CPUs)
+
+        Returns:
+            Array of results (e.g., A_btl__db for each distance), NaN where LFMF failed
+        """
+        compute_loss = partial(_compute_loss_in_process, h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s,
+                               epsilon=epsilon, sigma=sigma, pol=pol, result_index=result_index)
+        workers = max_workers or os.cpu_count() or 1
+        # Send the distances in chunks to amortize the cost of pickling
+        chunksize = max(1, len(distances) // (4 * workers))
+        # Spawn the workers, forking a process that ran the numba compiled loop
+        # can deadlock
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results = np.fromiter(executor.map(compute_loss, distances, chunksize=chunksize),
+                                  dtype=np.float64, count=len(distances))
+        n_failed = np.count_nonzero(np.isnan(results))
+        if n_failed:
+            logger.warning("LFMF failed on %d of %d distances", n_failed, len(distances))
+        return results
+
+
+# ITU368Grwave instance of a worker process of evaluate_distances_mp
+_process_grwave = None
+
+def _compute_loss_in_process(h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s, d__km, epsilon, sigma, pol, result_index):
+    ''' Worker function of evaluate_distances_mp, loads the library once per process.'''
+    global _process_grwave
+    if _process_grwave is None:
+        _process_grwave = ITU368Grwave()
+    try:
+        return _process_grwave.run_field(h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s, d__km, epsilon, sigma, pol, result_index)
+    except LFMFError:
+        # counted and reported by evaluate_distances_mp
+        return np.nan
+
 
 def main():
     # Define the input parameters
@@ -149,7 +457,7 @@ def main():
     distances = np.geomspace(1, 10000, 300) # [km]
     frequencies = np.array([0.01, 0.015, 0.02, 0.03, 0.04, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.4, 0.5, 0.75, 1., 1.5, 2., 3., 4., 5., 7.5, 10., 15., 20., 30.]) # [MHz]
     for f__mhz in frequencies:
-        results = grwave.evaluate_distances(h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s, distances, epsilon, sigma, pol, result_index=1)
+        results = grwave.evaluate_distances(h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s, distances, epsilon, sigma, pol, result_index=1, dtype=np.float32)
         plt.plot(distances, results, label=f'{f__mhz} MHz')
     plt.grid()
     plt.ylim(-30, 120)
@@ -0,0 +1,112 @@
+/* ITU 368 Groundwave Propagation - batch entry points
+This file adds entry points to the LFMF library that evaluate the model for a
+whole array of distances in a single call, so the python wrapper only has to
+cross the python/C boundary once per sweep instead of once per distance.
+Add this file to the LFMF project (next to LFMF.cpp) before building the
+LFMF.dll/LFMF.so.
+Marcel van den Broek, 2025 */
+
+#include <cmath>
+#include "LFMF.h"
+
+#if defined(_WIN32)
+#define LFMF_BATCH_EXPORT extern "C" __declspec(dllexport)
+#else
+#define LFMF_BATCH_EXPORT extern "C" __attribute__((visibility("default")))
+#endif
+
+/* Status code of LFMF for d__km out of range (see the errors of LFMF). LFMF
+validates its inputs in order, so the lower error codes are caused by
+parameters that are the same for every distance and are returned for every
+distance, whatever its value */
+#define LFMF_ERROR_D__KM 1005
+
+/* Parameters of LFMF that are the same for every distance of a sweep */
+struct LFMF_Ctx
+{
+    double h_tx__meter;
+    double h_rx__meter;
+    double f__mhz;
+    double P_tx__watt;
+    double N_s;
+    double epsilon;
+    double sigma;
+    int pol;
+};
+
+/* Evaluate LFMF for the parameters in ctx and n distances d__km[0..n-1] and
+store the results in results[0..n-1]. A failing distance does not stop the
+sweep: its fields are set to NAN and its method is set to the negative error
+code. If a parameter validated before the distance is invalid, LFMF is not
+called for the remaining distances as they fail with the same error. Returns the
+number of failed distances. */
+LFMF_BATCH_EXPORT int LFMF_batch(const LFMF_Ctx *ctx, const double *d__km,
+    int n, Result *results)
+{
+    int n_failed = 0;
+    for (int i = 0; i < n; i++)
+    {
+        int status = LFMF(ctx->h_tx__meter, ctx->h_rx__meter, ctx->f__mhz,
+                          ctx->P_tx__watt, ctx->N_s, d__km[i], ctx->epsilon,
+                          ctx->sigma, ctx->pol, &results[i]);
+        if (status != 0)
+        {
+            results[i].A_btl__db = NAN;
+            results[i].E_dBuVm = NAN;
+            results[i].P_rx__dbm = NAN;
+            results[i].method = -status;
+            n_failed++;
+            if (status < LFMF_ERROR_D__KM)
+            {
+                for (int j = i + 1; j < n; j++)
+                {
+                    results[j] = results[i];
+                }
+                return n_failed + (n - i - 1);
+            }
+        }
+    }
+    return n_failed;
+}
+
+/* Same as LFMF_batch, but only stores one field of the results as float in
+out_dB[0..n-1]: field 0 = A_btl__db, 1 = E_dBuVm, 2 = P_rx__dbm. A failed
+distance is set to NAN. The status of LFMF for every distance is stored in
+status[0..n-1]. Returns the number of failed distances, or -1 if field is
+not 0, 1 or 2. */
+LFMF_BATCH_EXPORT int LFMF_batch_dB(const LFMF_Ctx *ctx, const double *d__km,
+    int n, int field, float *out_dB, int *status)
+{
+    if (field < 0 || field > 2)
+    {
+        return -1;
+    }
+    int n_failed = 0;
+    Result res;
+    for (int i = 0; i < n; i++)
+    {
+        status[i] = LFMF(ctx->h_tx__meter, ctx->h_rx__meter, ctx->f__mhz,
+                         ctx->P_tx__watt, ctx->N_s, d__km[i], ctx->epsilon,
+                         ctx->sigma, ctx->pol, &res);
+        if (status[i] != 0)
+        {
+            out_dB[i] = NAN;
+            n_failed++;
+            if (status[i] < LFMF_ERROR_D__KM)
+            {
+                for (int j = i + 1; j < n; j++)
+                {
+                    out_dB[j] = NAN;
+                    status[j] = status[i];
+                }
+                return n_failed + (n - i - 1);
+            }
+        }
+        else
+        {
+            const double values[3] = {res.A_btl__db, res.E_dBuVm, res.P_rx__dbm};
+            out_dB[i] = (float)values[field];
+        }
+    }
+    return n_failed;
+}
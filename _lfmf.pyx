@@ -0,0 +1,41 @@
+# cython: language_level=3
+''' ITU 368 Groundwave Propagation - compiled call of LFMF
+Cython extension to call the C++ LFMF function with less overhead per call
+than ctypes. The function is called through its address in the LFMF library
+loaded by ITU368_grwave, so the extension does not need to be linked to the
+library. Build it with: python build_lfmf_ext.py
+Marcel van den Broek, 2025'''
+
+cdef struct Result:
+    double A_btl__db
+    double E_dBuVm
+    double P_rx__dbm
+    int method
+
+ctypedef int (*lfmf_t)(double, double, double, double, double, double, double,
+                       double, int, Result*) noexcept nogil
+
+
+cdef class LFMF:
+    ''' Callable wrapper around the LFMF function at the given address.'''
+    cdef lfmf_t fn
+
+    def __init__(self, size_t address):
+        self.fn = <lfmf_t>address
+
+    def __call__(self, double h_tx__meter, double h_rx__meter, double f__mhz,
+                 double P_tx__watt, double N_s, double d__km, double epsilon,
+                 double sigma, int pol):
+        ''' 
+        Call LFMF, parameters are the same as for ITU368Grwave.run.
+
+        Returns:
+            status: Status code returned by LFMF (0 = success)
+            A_btl__db, E_dBuVm, P_rx__dbm, method: Results as in ITU368Grwave.run
+        '''
+        cdef Result res
+        cdef int status
+        with nogil:
+            status = self.fn(h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s,
+                             d__km, epsilon, sigma, pol, &res)
+        return status, res.A_btl__db, res.E_dBuVm, res.P_rx__dbm, res.method
@@ -0,0 +1,56 @@
+''' Build the optional CFFI (API mode) module _lfmf_cffi used by ITU368Grwave.run.
+The module calls LFMF through its address in the LFMF library loaded by
+ITU368_grwave, so it does not need to be linked to the library.
+Run with: python _lfmf_cffi_build.py
+Marcel van den Broek, 2025'''
+
+from cffi import FFI
+
+ffibuilder = FFI()
+
+ffibuilder.cdef('''
+    typedef struct {
+        double A_btl__db;
+        double E_dBuVm;
+        double P_rx__dbm;
+        int method;
+    } Result;
+
+    void LFMF_set_address(uintptr_t address);
+    int LFMF(double h_tx__meter, double h_rx__meter, double f__mhz, double P_tx__watt,
+             double N_s, double d__km, double epsilon, double sigma, int pol,
+             Result *result);
+''')
+
+ffibuilder.set_source('_lfmf_cffi', '''
+    #include <stdint.h>
+
+    typedef struct {
+        double A_btl__db;
+        double E_dBuVm;
+        double P_rx__dbm;
+        int method;
+    } Result;
+
+    typedef int (*lfmf_t)(double, double, double, double, double, double,
+                          double, double, int, Result *);
+
+    /* LFMF function of the loaded library */
+    static lfmf_t lfmf_fn = NULL;
+
+    static void LFMF_set_address(uintptr_t address)
+    {
+        lfmf_fn = (lfmf_t)address;
+    }
+
+    static int LFMF(double h_tx__meter, double h_rx__meter, double f__mhz,
+                    double P_tx__watt, double N_s, double d__km, double epsilon,
+                    double sigma, int pol, Result *result)
+    {
+        return lfmf_fn(h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s,
+                       d__km, epsilon, sigma, pol, result);
+    }
+''')
+
+if __name__ == '__main__':
+    ffibuilder.compile(verbose=True)
@@ -0,0 +1,45 @@
+''' Build the optional ahead-of-time compiled module lfmf_driver used by
+ITU368Grwave.evaluate_distances. It contains the loop over the distances of
+the numba fallback, compiled in advance so it has no JIT compilation delay.
+The loop calls LFMF through its address in the loaded LFMF library, so the
+module does not need to be linked to the library. The loop is serial, as
+numba.pycc does not support parallel loops, so the module is only used when
+numba is not installed at runtime.
+numba.pycc is deprecated by numba (NumbaPendingDeprecationWarning) and will
+be removed in a future version of numba.
+Run with: python build_lfmf_driver.py
+Marcel van den Broek, 2025'''
+
+from llvmlite import ir
+from numba import types
+from numba.extending import intrinsic
+from numba.pycc import CC
+
+cc = CC('lfmf_driver')
+
+
+@intrinsic
+def _call_lfmf(typingctx, address, h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s, d__km, epsilon, sigma, pol, result_address):
+    ''' Numba intrinsic that calls the LFMF function at address, the result is
+    written at result_address.'''
+    sig = types.int32(types.intp, types.float64, types.float64, types.float64, types.float64, types.float64,
+                      types.float64, types.float64, types.float64, types.int32, types.intp)
+    def codegen(context, builder, signature, args):
+        voidptr = ir.IntType(8).as_pointer()
+        fnty = ir.FunctionType(ir.IntType(32), [ir.DoubleType()] * 8 + [ir.IntType(32), voidptr])
+        fn = builder.inttoptr(args[0], fnty.as_pointer())
+        return builder.call(fn, list(args[1:-1]) + [builder.inttoptr(args[-1], voidptr)])
+    return sig, codegen
+
+
+@cc.export('sweep', 'void(intp, f8, f8, f8, f8, f8, f8[::1], f8, f8, i4, intp, intp, i4[::1])')
+def sweep(lfmf_address, h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s, distances, epsilon, sigma, pol, out_address, itemsize, status):
+    ''' Call LFMF for every distance, the result of distance i is written at
+    out_address + i * itemsize and its status in status[i].'''
+    for i in range(distances.shape[0]):
+        status[i] = _call_lfmf(lfmf_address, h_tx__meter, h_rx__meter, f__mhz, P_tx__watt, N_s,
+                               distances[i], epsilon, sigma, pol, out_address + i * itemsize)
+
+
+if __name__ == '__main__':
+    cc.compile()
@@ -0,0 +1,10 @@
+''' Build the optional Cython extension _lfmf used by ITU368Grwave.run.
+Run with: python build_lfmf_ext.py
+Marcel van den Broek, 2025'''
+
+from setuptools import setup, Extension
+from Cython.Build import cythonize
+
+setup(name='_lfmf',
+      ext_modules=cythonize([Extension('_lfmf', ['_lfmf.pyx'])]),
+      script_args=['build_ext', '--inplace'])